@@ -1,13 +1,29 @@
 import os
 import sys
+import json
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
 from pathlib import Path
 from dotenv import load_dotenv
 import anthropic
+import docx
 from docx import Document
-import PyPDF2
+import pypdfium2 as pdfium
 import re
 import copy
+import difflib
+import time
+import hashlib
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import contextvars
+import zipfile
+from xml.sax.saxutils import escape
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
@@ -24,13 +40,44 @@ ZEROGPT_DETECT_TEXT_URL = "https://api.zerogpt.com/api/detect/detectText"
 
 SUPPORTED_EXTENSIONS = {".docx", ".pdf", ".txt"}
 
+# python-docx's bundled blank document, reused as the skeleton for .docx output
+DOCX_TEMPLATE = Path(docx.__file__).parent / "templates" / "default.docx"
+
+# Long documents are split into chunks that are sent to the APIs concurrently
+CHUNK_MAX_WORDS = 1500
+MAX_WORKERS = 4
+
+# Shared ZeroGPT session so repeated scans reuse keep-alive connections
+# (sized for batch mode, where up to MAX_WORKERS files each scan MAX_WORKERS chunks)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS * MAX_WORKERS))
+
+# Transient API failures are retried with exponential backoff
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 1
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER_SECONDS = 120
+
+# Successful text detections are memoised by content hash
+DETECTION_CACHE_SIZE = 64
+_detection_cache = OrderedDict()
+_detection_cache_lock = threading.Lock()
+
+# Prefix for progress output, set per file in batch mode
+_log_prefix = contextvars.ContextVar("log_prefix", default="")
+
 # Patterns to detect citations
-CITATION_PATTERNS = [
+CITATION_PATTERNS = [re.compile(p) for p in (
     r'\([A-Z][a-zA-Z]+(?:\s+(?:et\s+al\.?|&|and)\s+[A-Z][a-zA-Z]+)*,?\s*\d{4}[a-z]?\)',  # (Author, 2023) or (Author et al., 2023)
     r'\([A-Z][a-zA-Z]+\s+&\s+[A-Z][a-zA-Z]+,?\s*\d{4}\)',  # (Author & Author, 2023)
     r'\[\d+(?:[-,]\s*\d+)*\]',  # [1] or [1,2] or [1-3]
     r'\([A-Z][a-zA-Z]+,\s*\d{4},\s*p\.?\s*\d+\)',  # (Author, 2023, p. 45)
-]
+)]
+CITATION_RE = re.compile('|'.join(f'(?:{p.pattern})' for p in CITATION_PATTERNS))
+PLACEHOLDER_RE = re.compile(r'__CITATION_\d+__')
+
+# Control characters that are not allowed in XML text
+_XML_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
 # Keywords that indicate references section
 REFERENCES_KEYWORDS = [
@@ -45,31 +92,29 @@ TITLE_PAGE_KEYWORDS = [
     'assignment', 'thesis', 'dissertation', 'project', 'date:', 'name:'
 ]
 
+# Line endings that close a paragraph when re-flowing wrapped text
+SENTENCE_ENDINGS = ('.', '!', '?', ':', ';', '"', '\u201d')
 
-def is_heading(text: str) -> bool:
-    """Check if a line is likely a heading/title."""
-    text = text.strip()
-    if not text:
-        return False
+# Lines that stand alone when re-flowing wrapped text: list items and figure/table captions
+_STANDALONE_LINE_RE = re.compile(r'(?:[-\u2022*]\s|\d+[.)]\s|(?:figure|fig\.|table)\s+\d)', re.IGNORECASE)
 
-    # Short lines that are likely headings
-    if len(text) < 100:
-        # Numbered headings (1. Introduction, 1.1 Background)
-        if re.match(r'^\d+(\.\d+)*\.?\s+\w', text):
-            return True
-        # ALL CAPS headings
-        if text.isupper() and len(text.split()) <= 8:
-            return True
-        # Title Case headings (common patterns)
-        words = text.split()
-        if len(words) <= 8 and text.istitle():
-            return True
-        # Chapter/Section headings
-        if re.match(r'^(chapter|section|part|appendix)\s+\w', text, re.IGNORECASE):
-            return True
+# A rewritten block at least this similar to the original keeps the original line breaks
+UNCHANGED_SIMILARITY = 0.9
 
-    return False
+# Keywords in a heading that mark the start of the body
+BODY_START_KEYWORDS = ['introduction', 'abstract', 'chapter 1', '1.']
+
+# Line classification patterns
+_NUMBERED_HEADING_PATTERN = r'\d+(?:\.\d+)*\.?\s+\w'
+_CHAPTER_HEADING_PATTERN = r'(?:chapter|section|part|appendix)\s+\w'
+_REFERENCES_PATTERN = r'(?:' + '|'.join(map(re.escape, REFERENCES_KEYWORDS)) + r')'
 
+# Classifies a stripped line in one match: references start or numbered/chapter heading
+_LINE_CLASSIFIER = re.compile(
+    r'(?P<references>' + _REFERENCES_PATTERN + r'\s*$)'
+    r'|(?P<heading>' + _NUMBERED_HEADING_PATTERN + '|' + _CHAPTER_HEADING_PATTERN + ')',
+    re.IGNORECASE
+)
 
 def is_title_page_content(text: str) -> bool:
     """Check if text is part of title page."""
@@ -80,41 +125,105 @@ def is_title_page_content(text: str) -> bool:
     return False
 
 
-def is_references_section(text: str) -> bool:
-    """Check if we've entered the references section."""
-    text_lower = text.strip().lower()
-    for keyword in REFERENCES_KEYWORDS:
-        if text_lower == keyword or text_lower.startswith(keyword + '\n'):
-            return True
-        if re.match(rf'^{keyword}\s*$', text_lower):
-            return True
-    return False
+def classify_line(text: str, wrapped: bool = False) -> tuple[bool, bool]:
+    """Classify a stripped line as (references start, heading).
+
+    Set wrapped for PDF text, where a continuation line can start with a number
+    ("2019 the government..."); numbered headings must then also be short (five words or
+    fewer) or title/upper case.
+    """
+    # Blank and long lines can be neither, so skip every other check
+    if not text or len(text) >= 100:
+        return False, False
+
+    # Every classifier alternative starts with a letter or digit
+    kind = None
+    if text[0].isalnum():
+        match = _LINE_CLASSIFIER.match(text)
+        kind = match.lastgroup if match else None
+
+    if kind == 'references':
+        return True, False
+
+    # Case checks bail out early on prose, so run them before splitting into words
+    cased = text.isupper() or text.istitle()
+
+    if kind == 'heading':
+        if wrapped and text[0].isdigit():
+            # Wrapped fragments run long, so "short" is stricter than for cased headings
+            return False, cased or len(text.split()) <= 5
+        return False, True
 
+    return False, cased and len(text.split()) <= 8
 
-def protect_citations(text: str) -> tuple[str, dict]:
-    """Replace citations with placeholders to protect them."""
-    placeholders = {}
-    protected_text = text
-    counter = 0
 
-    for pattern in CITATION_PATTERNS:
-        matches = re.finditer(pattern, protected_text)
-        for match in matches:
-            citation = match.group()
-            placeholder = f"__CITATION_{counter}__"
-            placeholders[placeholder] = citation
-            protected_text = protected_text.replace(citation, placeholder, 1)
-            counter += 1
+def protect_citations(text: str, placeholders: dict = None) -> tuple[str, dict]:
+    """Replace citations with placeholders to protect them, optionally adding to existing placeholders."""
+    if placeholders is None:
+        placeholders = {}
+
+    def replace(match):
+        placeholder = f"__CITATION_{len(placeholders)}__"
+        placeholders[placeholder] = match.group()
+        return placeholder
+
+    protected_text = CITATION_RE.sub(replace, text)
 
     return protected_text, placeholders
 
 
 def restore_citations(text: str, placeholders: dict) -> str:
     """Restore citations from placeholders."""
-    restored_text = text
-    for placeholder, citation in placeholders.items():
-        restored_text = restored_text.replace(placeholder, citation)
-    return restored_text
+    return PLACEHOLDER_RE.sub(lambda m: placeholders.get(m.group(), m.group()), text)
+
+
+def split_into_chunks(text: str, max_words: int = CHUNK_MAX_WORDS) -> list:
+    """Split text into chunks of roughly max_words, breaking only at line boundaries."""
+    chunks = []
+    current = []
+    current_words = 0
+
+    for line in text.split('\n'):
+        line_words = len(line.split())
+        if current and current_words + line_words > max_words:
+            chunks.append('\n'.join(current))
+            current = []
+            current_words = 0
+        current.append(line)
+        current_words += line_words
+
+    if current:
+        chunks.append('\n'.join(current))
+
+    return chunks
+
+
+_client = None
+
+
+def get_client() -> anthropic.Anthropic:
+    """Return a shared Anthropic client, creating it on first use."""
+    global _client
+    if _client is None:
+        # The SDK retries rate limits, 5xx and connection errors with exponential backoff
+        _client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, max_retries=MAX_RETRIES)
+    return _client
+
+
+def log(message: str = ""):
+    """Print a progress message, tagged with the file being processed in batch mode."""
+    prefix = _log_prefix.get()
+    if prefix:
+        message = "\n".join(prefix + line if line else line for line in message.split("\n"))
+    # A single write keeps lines from concurrently processed files whole
+    sys.stdout.write(message + "\n")
+
+
+def run_concurrently(func, items: list) -> list:
+    """Map func over items on a thread pool, keeping order and the caller's log prefix."""
+    with ThreadPoolExecutor(max_workers=min(len(items), MAX_WORKERS)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+        return [future.result() for future in futures]
 
 
 def check_api_keys():
@@ -127,61 +236,141 @@ def check_api_keys():
         sys.exit(1)
 
 
-def list_files():
-    """List all supported files in the files_to_check directory."""
+def list_files(directory: Path = FILES_DIR) -> list:
+    """List all supported files in a directory (files_to_check by default)."""
     files = []
-    for f in FILES_DIR.iterdir():
+    for f in directory.iterdir():
         if f.is_file() and f.suffix.lower() in SUPPORTED_EXTENSIONS:
             files.append(f)
     return sorted(files)
 
 
+def retry_after_seconds(response):
+    """Return the delay requested by a Retry-After header, or None if absent or unreadable."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def post_with_backoff(send) -> requests.Response:
+    """Call send() and retry failed connections and 429/5xx responses with exponential backoff.
+
+    Read timeouts are not retried: ZeroGPT has probably received the request by then and
+    charged for it, so resending could spend the quota again.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        delay = BACKOFF_SECONDS * 2 ** attempt
+        try:
+            response = send()
+        except requests.exceptions.ConnectionError:
+            # Includes ConnectTimeout, where the request never reached the server
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                return response
+            if response.status_code == 429:
+                delay = min(MAX_RETRY_AFTER_SECONDS, retry_after_seconds(response) or delay)
+        time.sleep(delay)
+
+
 def detect_ai_in_file(file_path: Path) -> dict:
     """Send file to ZeroGPT for AI detection."""
     headers = {"ApiKey": ZEROGPT_API_KEY}
 
     try:
-        with open(file_path, "rb") as f:
-            files = {"file": (file_path.name, f)}
-            response = requests.post(ZEROGPT_DETECT_FILE_URL, headers=headers, files=files, timeout=60)
+        def send():
+            with open(file_path, "rb") as f:
+                # Stream the multipart body from disk instead of building it in memory
+                encoder = MultipartEncoder(fields={"file": (file_path.name, f, "application/octet-stream")})
+                return SESSION.post(
+                    ZEROGPT_DETECT_FILE_URL,
+                    headers={**headers, "Content-Type": encoder.content_type},
+                    data=encoder,
+                    timeout=60
+                )
+
+        response = post_with_backoff(send)
 
         if response.status_code == 200:
             result = response.json()
             # Debug output
             if not result.get("success"):
-                print(f"  ZeroGPT API returned error: {result}")
+                log(f"  ZeroGPT API returned error: {result}")
             return result
         else:
-            print(f"  HTTP Error from ZeroGPT: {response.status_code}")
-            print(f"  Response: {response.text[:500]}")
+            log(f"  HTTP Error from ZeroGPT: {response.status_code}")
+            log(f"  Response: {response.text[:500]}")
             return {"success": False, "message": f"HTTP {response.status_code}"}
     except requests.exceptions.RequestException as e:
-        print(f"  Request error: {e}")
+        log(f"  Request error: {e}")
         return {"success": False, "message": str(e)}
 
 
 def detect_ai_in_text(text: str) -> dict:
+    """Detect AI content in text, reusing results for text that was already scanned."""
+    key = hashlib.blake2b(text.encode("utf-8")).hexdigest()
+
+    with _detection_cache_lock:
+        if key in _detection_cache:
+            _detection_cache.move_to_end(key)
+            return _detection_cache[key]
+
+    result = request_text_detection(text)
+
+    # Only cache successes so failed requests are retried next time
+    if result.get("success"):
+        with _detection_cache_lock:
+            _detection_cache[key] = result
+            if len(_detection_cache) > DETECTION_CACHE_SIZE:
+                _detection_cache.popitem(last=False)
+
+    return result
+
+
+def request_text_detection(text: str) -> dict:
     """Send text to ZeroGPT for AI detection."""
     headers = {"ApiKey": ZEROGPT_API_KEY}
     payload = {"input_text": text}
 
     try:
-        response = requests.post(ZEROGPT_DETECT_TEXT_URL, headers=headers, json=payload, timeout=60)
+        response = post_with_backoff(
+            lambda: SESSION.post(ZEROGPT_DETECT_TEXT_URL, headers=headers, json=payload, timeout=60)
+        )
 
         if response.status_code == 200:
             result = response.json()
             if not result.get("success"):
-                print(f"  ZeroGPT API returned error: {result}")
+                log(f"  ZeroGPT API returned error: {result}")
             return result
         else:
-            print(f"  HTTP Error from ZeroGPT: {response.status_code}")
-            print(f"  Response: {response.text[:500]}")
+            log(f"  HTTP Error from ZeroGPT: {response.status_code}")
+            log(f"  Response: {response.text[:500]}")
             return {"success": False, "message": f"HTTP {response.status_code}"}
     except requests.exceptions.RequestException as e:
-        print(f"  Request error: {e}")
+        log(f"  Request error: {e}")
         return {"success": False, "message": str(e)}
 
 
+def detect_ai_in_chunks(text: str) -> dict:
+    """Send text to ZeroGPT in concurrent chunks and merge the results."""
+    chunks = split_into_chunks(text)
+    if len(chunks) == 1:
+        return detect_ai_in_text(text)
+
+    results = run_concurrently(detect_ai_in_text, chunks)
+
+    return merge_detection_results(results, chunks)
+
+
 def extract_text_from_file(file_path: Path) -> str:
     """Extract text content from a file."""
     suffix = file_path.suffix.lower()
@@ -196,18 +385,27 @@ def extract_text_from_file(file_path: Path) -> str:
         return "\n".join(paragraphs)
 
     elif suffix == ".pdf":
-        text = ""
-        with open(file_path, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        return text
+        pdf = pdfium.PdfDocument(str(file_path))
+        try:
+            pages = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                # PDFium reports line breaks as CRLF
+                pages.append(textpage.get_text_range().replace("\r\n", "\n"))
+                textpage.close()
+                page.close()
+            return "\n".join(pages)
+        finally:
+            pdf.close()
 
     return ""
 
 
-def extract_document_sections(text: str) -> dict:
-    """Split document into sections: title_page, body, references."""
+def extract_document_sections(text: str, wrapped: bool = False) -> dict:
+    """Split document into sections: title_page, body, references.
+
+    Set wrapped for PDF text (see classify_line).
+    """
     lines = text.split('\n')
     sections = {
         'title_page': [],
@@ -221,26 +419,29 @@ def extract_document_sections(text: str) -> dict:
     body_started = False
 
     for i, line in enumerate(lines):
+        if in_references:
+            sections['references'].append(line)
+            continue
+
         stripped = line.strip()
+        is_references, heading = classify_line(stripped, wrapped)
 
         # Check for references section start
-        if is_references_section(stripped):
+        if is_references:
             in_references = True
             in_title_page = False
             sections['references'].append(line)
             continue
 
-        if in_references:
-            sections['references'].append(line)
-            continue
-
         # Check if still in title page area (first few paragraphs with title-like content)
         if in_title_page:
-            if is_title_page_content(stripped) or (not body_started and len(sections['title_page']) < 15):
+            is_title = is_title_page_content(stripped)
+            if is_title or (not body_started and len(sections['title_page']) < 15):
                 sections['title_page'].append(line)
                 # Check if this looks like a main heading that starts the body
-                if is_heading(stripped) and not is_title_page_content(stripped):
-                    if any(kw in stripped.lower() for kw in ['introduction', 'abstract', 'chapter 1', '1.']):
+                if heading and not is_title:
+                    stripped_lower = stripped.lower()
+                    if any(kw in stripped_lower for kw in BODY_START_KEYWORDS):
                         in_title_page = False
                         body_started = True
                         sections['body'].append(line)
@@ -251,7 +452,7 @@ def extract_document_sections(text: str) -> dict:
                 body_started = True
 
         # We're in the body section
-        if is_heading(stripped):
+        if heading:
             sections['headings'][len(sections['body'])] = stripped
 
         sections['body'].append(line)
@@ -259,15 +460,15 @@ def extract_document_sections(text: str) -> dict:
     return sections
 
 
-def reconstruct_document(sections: dict) -> str:
-    """Reconstruct document from sections."""
+def reconstruct_document(sections: dict, body_text: str = None) -> str:
+    """Reconstruct document from sections, optionally substituting the body text."""
     parts = []
 
     if sections['title_page']:
         parts.append('\n'.join(sections['title_page']))
 
     if sections['body']:
-        parts.append('\n'.join(sections['body']))
+        parts.append('\n'.join(sections['body']) if body_text is None else body_text)
 
     if sections['references']:
         parts.append('\n'.join(sections['references']))
@@ -275,26 +476,36 @@ def reconstruct_document(sections: dict) -> str:
     return '\n'.join(parts)
 
 
-def humanise_text(text: str, ai_sentences: list = None) -> str:
-    """Use Claude to humanise the text while keeping formal academic tone."""
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+def parse_paragraphs_response(response_text: str):
+    """Parse Claude's JSON array of paragraphs, returning None if it is malformed."""
+    response_text = response_text.strip()
+    # Tolerate the array being wrapped in a markdown code fence
+    if response_text.startswith("```"):
+        response_text = response_text.strip("`")
+        if response_text.startswith("json"):
+            response_text = response_text[4:]
 
-    # Extract document sections
-    sections = extract_document_sections(text)
+    try:
+        paragraphs = json.loads(response_text)
+    except ValueError:
+        return None
 
-    # Only humanise the body, protect citations
-    body_text = '\n'.join(sections['body'])
-    protected_body, citation_placeholders = protect_citations(body_text)
+    if not isinstance(paragraphs, list) or not all(isinstance(p, str) for p in paragraphs):
+        return None
+    return paragraphs
 
-    # Get the headings to pass to Claude
-    headings_list = list(sections['headings'].values())
-    headings_note = ""
-    if headings_list:
-        headings_note = "\n\nHEADINGS TO PRESERVE EXACTLY:\n" + "\n".join(f"- {h}" for h in headings_list[:20])
 
-    prompt = f"""You are an expert academic writer helping a BSc graduate student rewrite their work to sound more natural and human-written while maintaining academic standards.
+def humanise_chunk(client, chunk: str, headings_note: str) -> str:
+    """Ask Claude to rewrite a chunk of protected body text as one batch of paragraphs."""
+    lines = chunk.split('\n')
+    paragraph_indexes = [i for i, line in enumerate(lines) if line.strip()]
+    if not paragraph_indexes:
+        return chunk
+    paragraphs = [lines[i] for i in paragraph_indexes]
+
+    instructions = f"""You are an expert academic writer helping a BSc graduate student rewrite their work to sound more natural and human-written while maintaining academic standards.
 
-TASK: Rewrite the following text to:
+TASK: Rewrite the following paragraphs to:
 1. Sound naturally human-written (avoid AI-typical patterns)
 2. Maintain a formal, academic tone suitable for university assignments
 3. Keep the same meaning, facts, and structure
@@ -317,57 +528,211 @@ ONLY REWRITE: The body paragraph text - the actual discussion/content sentences.
 IMPORTANT:
 - Do NOT add any preamble or explanation
 - Do NOT say "Here is the rewritten text" or similar
-- Just output the rewritten text directly
+- The user message is a JSON object whose "paragraphs" list holds the body text to rewrite, in order
+- Return a JSON array of rewritten paragraphs: one string per input paragraph, in the same order, and nothing else
 - Keep approximately the same length
-- Maintain the exact same document structure and paragraph order
-
-BODY TEXT TO REWRITE:
-{protected_body}"""
+- Maintain the exact same document structure and paragraph order"""
 
     message = client.messages.create(
         model="claude-sonnet-4-20250514",
         max_tokens=8192,
+        system=instructions,
         messages=[
-            {"role": "user", "content": prompt}
+            {"role": "user", "content": json.dumps({"paragraphs": paragraphs})}
         ]
     )
 
-    humanised_body = message.content[0].text
+    rewritten = parse_paragraphs_response(message.content[0].text)
+    if rewritten is None or len(rewritten) != len(paragraphs):
+        log("  Warning: Claude returned an unexpected paragraph list, keeping chunk unchanged")
+        return chunk
+
+    for i, paragraph in zip(paragraph_indexes, rewritten):
+        # Body lines are paragraphs, so keep each rewrite on a single line
+        lines[i] = paragraph.replace('\n', ' ')
+    return '\n'.join(lines)
+
+
+def find_flagged_paragraphs(paragraphs: list, ai_sentences: list) -> list:
+    """Return indexes of paragraphs containing any sentence ZeroGPT flagged as AI-written."""
+    # Compare with whitespace collapsed, since flagged sentences may span wrapped lines
+    sentences = [' '.join(s.split()) for s in ai_sentences if isinstance(s, str) and s.strip()]
+    flagged = []
+    for i, paragraph in enumerate(paragraphs):
+        normalised = ' '.join(paragraph.split())
+        if any(sentence in normalised for sentence in sentences):
+            flagged.append(i)
+    return flagged
+
+
+def group_paragraphs(lines: list, reflow: bool) -> list:
+    """Group body lines into paragraphs, returned as (start, end) line ranges.
+
+    Without reflow every non-blank line is its own paragraph. With reflow (PDF text, which is
+    wrapped one visual line at a time), a line that does not end a sentence continues into the
+    next one. Blank lines and headings always separate paragraphs, and list items and
+    figure/table captions always stand alone.
+    """
+    blocks = []
+    start = None
+    previous_standalone = False
+
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped:
+            if start is not None:
+                blocks.append((start, i))
+                start = None
+            continue
+
+        standalone = classify_line(stripped, reflow)[1] or bool(_STANDALONE_LINE_RE.match(stripped))
+        if start is not None:
+            continues = (reflow and not standalone and not previous_standalone
+                         and not lines[i - 1].rstrip().endswith(SENTENCE_ENDINGS))
+            if not continues:
+                blocks.append((start, i))
+                start = None
+        if start is None:
+            start = i
+        previous_standalone = standalone
+
+    if start is not None:
+        blocks.append((start, len(lines)))
+
+    return blocks
+
+
+def rewrap(text: str, original_lines: list) -> list:
+    """Break text into lines holding the same number of words as the original lines."""
+    words = text.split()
+    wrapped = []
+    position = 0
+    for i, line in enumerate(original_lines):
+        count = len(line.split()) if i < len(original_lines) - 1 else len(words)
+        if position >= len(words):
+            break
+        wrapped.append(' '.join(words[position:position + count]))
+        position += count
+    return wrapped
+
+
+def humanise_body(body_text: str, headings: dict, ai_sentences: list = None, reflow: bool = False) -> str:
+    """Use Claude to humanise the body text while keeping formal academic tone.
+
+    If ai_sentences is given, only paragraphs containing one of those sentences are rewritten.
+    Set reflow for PDF text, whose paragraphs are wrapped across lines (see group_paragraphs).
+    """
+    client = get_client()
+
+    lines = body_text.split('\n')
+    blocks = group_paragraphs(lines, reflow)
+    paragraphs = [' '.join(line.strip() for line in lines[start:end]) if end - start > 1 else lines[start]
+                  for start, end in blocks]
+
+    # Rewrite only the paragraphs still flagged as AI, or everything if none can be matched
+    targets = find_flagged_paragraphs(paragraphs, ai_sentences) if ai_sentences else []
+    if targets:
+        log(f"  Rewriting {len(targets)} flagged paragraph(s)")
+    else:
+        targets = list(range(len(paragraphs)))
+
+    # Protect citations in the paragraphs being rewritten
+    citation_placeholders = {}
+    protected = [protect_citations(paragraphs[i], citation_placeholders)[0] for i in targets]
+
+    # Get the headings to pass to Claude
+    headings_list = list(headings.values())
+    headings_note = ""
+    if headings_list:
+        headings_note = "\n\nHEADINGS TO PRESERVE EXACTLY:\n" + "\n".join(f"- {h}" for h in headings_list[:20])
+
+    # Rewrite chunks concurrently, keeping their original order; each paragraph is one line
+    chunks = split_into_chunks('\n'.join(protected))
+    humanised_chunks = run_concurrently(lambda c: humanise_chunk(client, c, headings_note), chunks)
+
+    rewritten = {}
+    for i, paragraph in zip(targets, '\n'.join(humanised_chunks).split('\n')):
+        # Restore citations; paragraphs Claude left unchanged keep their original line breaks
+        paragraph = restore_citations(paragraph, citation_placeholders)
+        if paragraph != paragraphs[i]:
+            rewritten[i] = paragraph
+
+    # Splice the rewritten paragraphs back between the untouched lines
+    result = []
+    position = 0
+    for i, (start, end) in enumerate(blocks):
+        result.extend(lines[position:start])
+        if i in rewritten:
+            original = paragraphs[i]
+            if end - start > 1 and difflib.SequenceMatcher(None, original, rewritten[i]).ratio() >= UNCHANGED_SIMILARITY:
+                # Barely changed, so keep the block's original line structure
+                result.extend(rewrap(rewritten[i], lines[start:end]))
+            else:
+                result.append(rewritten[i])
+        else:
+            result.extend(lines[start:end])
+        position = end
+    result.extend(lines[position:])
+
+    return '\n'.join(result)
 
-    # Restore citations
-    humanised_body = restore_citations(humanised_body, citation_placeholders)
 
-    # Reconstruct full document
-    sections['body'] = humanised_body.split('\n')
-    full_text = reconstruct_document(sections)
+_docx_template = None
 
-    return full_text
+
+def load_docx_template() -> tuple[dict, str, str]:
+    """Read the .docx template once, returning its other parts and the XML around the body."""
+    global _docx_template
+    if _docx_template is None:
+        with zipfile.ZipFile(DOCX_TEMPLATE) as template:
+            parts = {name: template.read(name) for name in template.namelist()}
+        document_xml = parts.pop("word/document.xml").decode("utf-8")
+        # Paragraphs go before the section properties at the end of the body
+        split = document_xml.index("<w:sectPr")
+        _docx_template = (parts, document_xml[:split], document_xml[split:])
+    return _docx_template
+
+
+def docx_paragraph_xml(text: str) -> str:
+    """Build the WordprocessingML for a single plain-text paragraph."""
+    text = _XML_INVALID_RE.sub("", text)
+    runs = "<w:tab/>".join(f'<w:t xml:space="preserve">{escape(part)}</w:t>' for part in text.split("\t"))
+    return f"<w:p><w:r>{runs}</w:r></w:p>"
+
+
+def output_path_for(original_path: Path, version: int) -> Path:
+    """Return where a humanised version of a file is saved."""
+    stem = original_path.stem
+    suffix = original_path.suffix.lower()
+    if suffix == ".pdf":
+        # Saved as txt; tag the name so it cannot clash with a same-named .txt input
+        return OUTPUT_DIR / f"{stem}_pdf_humanised_v{version}.txt"
+    return OUTPUT_DIR / f"{stem}_humanised_v{version}{suffix}"
 
 
 def save_text_to_file(text: str, original_path: Path, version: int) -> Path:
     """Save humanised text to a new file."""
-    stem = original_path.stem
     suffix = original_path.suffix.lower()
-    new_name = f"{stem}_humanised_v{version}{suffix}"
-    output_path = OUTPUT_DIR / new_name
+    output_path = output_path_for(original_path, version)
 
     if suffix == ".txt":
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(text)
 
     elif suffix == ".docx":
-        doc = Document()
-        for para in text.split("\n"):
-            if para.strip():
-                doc.add_paragraph(para)
-        doc.save(output_path)
+        # Write document.xml directly instead of building python-docx objects per paragraph
+        parts, body_start, body_end = load_docx_template()
+        paragraphs = "".join(docx_paragraph_xml(para) for para in text.split("\n") if para.strip())
+        with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as output:
+            for name, data in parts.items():
+                output.writestr(name, data)
+            output.writestr("word/document.xml", body_start + paragraphs + body_end)
 
     elif suffix == ".pdf":
         # Save as txt since creating PDFs is complex
-        output_path = OUTPUT_DIR / f"{stem}_humanised_v{version}.txt"
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(text)
-        print(f"  Note: PDF converted to TXT for output")
+        log(f"  Note: PDF converted to TXT for output")
 
     return output_path
 
@@ -406,16 +771,54 @@ def get_ai_sentences(result: dict) -> list:
     return sentences if isinstance(sentences, list) else []
 
 
+def merge_detection_results(results: list, chunks: list) -> dict:
+    """Combine per-chunk ZeroGPT results into a single word-weighted result."""
+    for result in results:
+        if not result or not result.get("success"):
+            return result
+
+    total_words = 0
+    ai_words = 0
+    weighted_percentage = 0.0
+    sentences = []
+
+    for result, chunk in zip(results, chunks):
+        data = result.get("data") or {}
+        try:
+            words = int(data.get("textWords"))
+        except (TypeError, ValueError):
+            words = len(chunk.split())
+        try:
+            ai_words += int(data.get("aiWords"))
+        except (TypeError, ValueError):
+            pass
+        total_words += words
+        weighted_percentage += parse_ai_percentage(result) * words
+        sentences.extend(get_ai_sentences(result))
+
+    fake_percentage = round(weighted_percentage / total_words, 2) if total_words else 0
+
+    return {
+        "success": True,
+        "data": {
+            "fakePercentage": fake_percentage,
+            "textWords": total_words,
+            "aiWords": ai_words,
+            "sentences": sentences,
+        }
+    }
+
+
 def display_results(result: dict, file_name: str):
     """Display detection results."""
     if not result:
-        print("  Failed to get results")
+        log("  Failed to get results")
         return
 
     # Debug: print raw response if there's an issue
     if not result.get("success"):
-        print(f"  API Error: {result.get('message', 'Unknown error')}")
-        print(f"  Raw response: {result}")
+        log(f"  API Error: {result.get('message', 'Unknown error')}")
+        log(f"  Raw response: {result}")
         return
 
     data = result.get("data") or {}
@@ -423,146 +826,233 @@ def display_results(result: dict, file_name: str):
     text_words = data.get("textWords", "N/A")
     ai_words = data.get("aiWords", "N/A")
 
-    print(f"\n  Results for: {file_name}")
-    print(f"  {'-' * 40}")
-    print(f"  AI Percentage: {ai_percentage}%")
-    print(f"  Total Words: {text_words}")
-    print(f"  AI Words: {ai_words}")
-    print(f"  {'-' * 40}")
-
-
-def main():
-    print("\n" + "=" * 50)
-    print("  AI CONTENT HUMANISER")
-    print("=" * 50)
-
-    check_api_keys()
-
-    # Ensure directories exist
-    FILES_DIR.mkdir(exist_ok=True)
-    OUTPUT_DIR.mkdir(exist_ok=True)
-
-    # List available files
-    files = list_files()
-
-    if not files:
-        print(f"\nNo supported files found in: {FILES_DIR}")
-        print(f"Please add .docx, .pdf, or .txt files to check.")
-        sys.exit(0)
+    log(f"\n  Results for: {file_name}")
+    log(f"  {'-' * 40}")
+    log(f"  AI Percentage: {ai_percentage}%")
+    log(f"  Total Words: {text_words}")
+    log(f"  AI Words: {ai_words}")
+    log(f"  {'-' * 40}")
 
-    print(f"\nFiles available in {FILES_DIR.name}/:\n")
-    for i, f in enumerate(files, 1):
-        print(f"  {i}. {f.name}")
-
-    # Get user selection
-    print()
-    while True:
-        try:
-            choice = input("Select file number (or 'q' to quit): ").strip()
-            if choice.lower() == 'q':
-                print("Goodbye!")
-                sys.exit(0)
-
-            choice_idx = int(choice) - 1
-            if 0 <= choice_idx < len(files):
-                selected_file = files[choice_idx]
-                break
-            else:
-                print("Invalid selection. Try again.")
-        except ValueError:
-            print("Please enter a number.")
 
-    # Get target percentage
+def prompt_target_percentage() -> float:
+    """Ask the user for the target AI percentage."""
     while True:
         try:
             target = input("Enter target AI percentage (e.g., 20): ").strip()
             target_percentage = float(target)
             if 0 <= target_percentage <= 100:
-                break
+                return target_percentage
             else:
                 print("Please enter a value between 0 and 100.")
         except ValueError:
             print("Please enter a valid number.")
 
-    print(f"\n{'=' * 50}")
-    print(f"Processing: {selected_file.name}")
-    print(f"Target: Below {target_percentage}% AI content")
-    print(f"{'=' * 50}")
+
+def process_file(selected_file: Path, target_percentage: float) -> float:
+    """Humanise a file until it scans below the target. Returns the final AI percentage, or -1 on error."""
+    log(f"\n{'=' * 50}")
+    log(f"Processing: {selected_file.name}")
+    log(f"Target: Below {target_percentage}% AI content")
+    log(f"{'=' * 50}")
 
     # Initial scan
-    print("\n[1] Scanning original file...")
+    log("\n[1] Scanning original file...")
     result = detect_ai_in_file(selected_file)
     display_results(result, selected_file.name)
 
     current_percentage = parse_ai_percentage(result)
 
     if current_percentage < 0:
-        print("Error: Could not get AI percentage from scan.")
-        sys.exit(1)
+        log("Error: Could not get AI percentage from scan.")
+        return -1
 
     if current_percentage <= target_percentage:
-        print(f"\nFile is already below target ({current_percentage}% <= {target_percentage}%)")
-        print("No humanisation needed!")
-        sys.exit(0)
+        log(f"\nFile is already below target ({current_percentage}% <= {target_percentage}%)")
+        log("No humanisation needed!")
+        return current_percentage
 
     # Extract text for humanisation
-    print("\n[2] Extracting text from file...")
+    log("\n[2] Extracting text from file...")
     current_text = extract_text_from_file(selected_file)
 
     if not current_text.strip():
-        print("Error: Could not extract text from file.")
-        sys.exit(1)
+        log("Error: Could not extract text from file.")
+        return -1
 
-    print(f"  Extracted {len(current_text.split())} words")
+    log(f"  Extracted {len(current_text.split())} words")
+
+    # Title page and references never change, so split the document only once
+    # .docx and .txt paragraphs are one per line; PDF text is wrapped per visual line
+    reflow = selected_file.suffix.lower() == ".pdf"
+
+    sections = extract_document_sections(current_text, reflow)
+    body_text = '\n'.join(sections['body'])
 
     # Humanisation loop
     version = 1
+    ai_sentences = None  # The first attempt rewrites the whole body
     max_iterations = 10  # Safety limit
     current_file = selected_file
 
     while current_percentage > target_percentage and version <= max_iterations:
-        print(f"\n[{version + 2}] Humanising text (attempt {version})...")
+        log(f"\n[{version + 2}] Humanising text (attempt {version})...")
 
-        # Humanise the text
-        humanised_text = humanise_text(current_text)
+        # Humanise the body and reassemble the document
+        body_text = humanise_body(body_text, sections['headings'], ai_sentences, reflow)
+        humanised_text = reconstruct_document(sections, body_text)
 
         # Save to new file
         output_file = save_text_to_file(humanised_text, selected_file, version)
-        print(f"  Saved to: {output_file.name}")
+        log(f"  Saved to: {output_file.name}")
 
         # Re-scan
-        print(f"\n[{version + 3}] Re-scanning humanised file...")
+        log(f"\n[{version + 3}] Re-scanning humanised file...")
 
         # Use text detection for re-scan (faster and works with our output)
-        result = detect_ai_in_text(humanised_text)
+        result = detect_ai_in_chunks(humanised_text)
         display_results(result, output_file.name)
 
         current_percentage = parse_ai_percentage(result)
 
         if current_percentage < 0:
-            print("Error: Could not get AI percentage from re-scan.")
+            log("Error: Could not get AI percentage from re-scan.")
             break
 
         if current_percentage <= target_percentage:
-            print(f"\n{'=' * 50}")
-            print(f"  SUCCESS!")
-            print(f"  Final AI percentage: {current_percentage}%")
-            print(f"  Target was: {target_percentage}%")
-            print(f"  Output file: {output_file}")
-            print(f"{'=' * 50}")
+            log(f"\n{'=' * 50}")
+            log(f"  SUCCESS!")
+            log(f"  Final AI percentage: {current_percentage}%")
+            log(f"  Target was: {target_percentage}%")
+            log(f"  Output file: {output_file}")
+            log(f"{'=' * 50}")
             break
 
-        # Prepare for next iteration
-        current_text = humanised_text
+        # Prepare for next iteration, focusing on the sentences still flagged as AI
+        ai_sentences = get_ai_sentences(result)
         version += 1
 
         if version > max_iterations:
-            print(f"\nReached maximum iterations ({max_iterations}).")
-            print(f"Current AI percentage: {current_percentage}%")
-            print(f"Latest file: {output_file}")
+            log(f"\nReached maximum iterations ({max_iterations}).")
+            log(f"Current AI percentage: {current_percentage}%")
+            log(f"Latest file: {output_file}")
+
+    return current_percentage
+
+
+def process_batch(directory: Path, target_percentage: float):
+    """Humanise every supported file in a directory concurrently."""
+    files = list_files(directory)
+
+    if not files:
+        print(f"\nNo supported files found in: {directory}")
+        sys.exit(0)
+
+    # Files whose outputs would overwrite each other cannot run in the same batch
+    outputs = {}
+    for f in files:
+        outputs.setdefault(output_path_for(f, 1).name, []).append(f.name)
+    clashes = [names for names in outputs.values() if len(names) > 1]
+    if clashes:
+        for names in clashes:
+            print(f"\nError: {', '.join(names)} would write the same output files")
+        print("Rename one of each group and try again.")
+        sys.exit(1)
+
+    print(f"\nBatch processing {len(files)} file(s) from {directory}/")
+
+    def process(file_path: Path) -> float:
+        # Tag this file's progress lines so concurrent output stays readable
+        _log_prefix.set(f"[{file_path.name}] ")
+        # One failing file should not abort the rest of the batch
+        try:
+            return process_file(file_path, target_percentage)
+        except Exception as e:
+            log(f"  Error processing: {e}")
+            return -1
+
+    # Work is network-bound, so threads are enough and share the API clients and detection cache
+    percentages = run_concurrently(process, files)
+
+    print(f"\n{'=' * 50}")
+    print("  BATCH SUMMARY")
+    print(f"{'=' * 50}")
+    for f, percentage in zip(files, percentages):
+        status = "error" if percentage < 0 else f"{percentage}% AI"
+        print(f"  {f.name}: {status}")
+
+    if any(percentage < 0 for percentage in percentages):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Humanise AI-detected content in assignment files.")
+    parser.add_argument("--batch", metavar="DIR", type=Path,
+                        help="process every supported file in DIR concurrently instead of picking one")
+    parser.add_argument("--target", type=float,
+                        help="target AI percentage (prompted for if omitted)")
+    args = parser.parse_args()
+
+    if args.batch is not None and not args.batch.is_dir():
+        parser.error(f"--batch directory not found: {args.batch}")
+    if args.target is not None and not 0 <= args.target <= 100:
+        parser.error("--target must be between 0 and 100")
+
+    print("\n" + "=" * 50)
+    print("  AI CONTENT HUMANISER")
+    print("=" * 50)
+
+    check_api_keys()
+
+    # Ensure directories exist
+    FILES_DIR.mkdir(exist_ok=True)
+    OUTPUT_DIR.mkdir(exist_ok=True)
+
+    if args.batch is not None:
+        target_percentage = args.target if args.target is not None else prompt_target_percentage()
+        process_batch(args.batch, target_percentage)
+        print("\nDone!")
+        return
+
+    # List available files
+    files = list_files()
+
+    if not files:
+        print(f"\nNo supported files found in: {FILES_DIR}")
+        print(f"Please add .docx, .pdf, or .txt files to check.")
+        sys.exit(0)
+
+    print(f"\nFiles available in {FILES_DIR.name}/:\n")
+    for i, f in enumerate(files, 1):
+        print(f"  {i}. {f.name}")
+
+    # Get user selection
+    print()
+    while True:
+        try:
+            choice = input("Select file number (or 'q' to quit): ").strip()
+            if choice.lower() == 'q':
+                print("Goodbye!")
+                sys.exit(0)
+
+            choice_idx = int(choice) - 1
+            if 0 <= choice_idx < len(files):
+                selected_file = files[choice_idx]
+                break
+            else:
+                print("Invalid selection. Try again.")
+        except ValueError:
+            print("Please enter a number.")
+
+    # Get target percentage
+    target_percentage = args.target if args.target is not None else prompt_target_percentage()
+
+    final_percentage = process_file(selected_file, target_percentage)
 
     print("\nDone!")
 
+    if final_percentage < 0:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()